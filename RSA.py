@@ -54,9 +54,34 @@ except: # microPython
     from ubinascii import b2a_base64 as b64encode
     from ubinascii import a2b_base64 as b64decode
 
+# Use GMP's arithmetic for key generation if gmpy2 is installed,
+# otherwise fall back on native integers, pow() and our own eea()
+try:
+    from gmpy2 import mpz, powmod, invert
+except: # plain Python / microPython
+    mpz = int
+    powmod = pow
+    invert = None
+
+from collections import namedtuple
+
+# Random number source for key generation
+from os import urandom as randBytes
+
+# Search for the two primes in parallel where we can
+try: # regular Python
+    from concurrent.futures import ProcessPoolExecutor
+    from os import cpu_count
+except: # microPython
+    ProcessPoolExecutor = None
+
 # Key generation on a microcontroller can be very slow
 # especially for larger key sizes.
-KEY_SIZE = 1024 # eg 1024, 2048, 3072
+KEY_SIZE = 2048 # eg 1024, 2048, 3072
+
+# Set True to do the modular exponentiation with our own montPow() (below)
+# rather than pow(), to see Montgomery multiplication at work
+USE_MONTPOW = False
 
 # Arbitrary integer test 'message', change at will
 # should be of shorter bit-length than KEY_SIZE
@@ -67,12 +92,21 @@ MSG = 1234567890123456789012345678901234
 
 # -------- some supporting functions ---------------------
 
+# Odd primes below 1000, dividing by these is a quick way to weed out
+# most prime candidates before resorting to the slow Miller-Rabin test
+SMALL_PRIMES = [p for p in range(3, 1000, 2) if all(p % f for f in range(3, int(p**0.5)+1, 2))]
+
 # microPython does not support int.bit_length()
-def bitLen(n):
-    return len(bin(n))-2
+try:
+    (1).bit_length()
+    def bitLen(n):
+        return n.bit_length()
+except:
+    def bitLen(n):
+        return len(bin(n))-2
 
 def bytLen(n):
-    return (len(hex(n))-1)//2
+    return (bitLen(n) + 7) >> 3
 
 # As the name suggests, +ve input only
 def bigInt2Bytes(bigI):
@@ -86,73 +120,201 @@ def bigInt2B64(bigInt):
 def B642bigInt(strIn):
     return int.from_bytes(b64decode(strIn), 'big')
 
+# Montgomery modular exponentiation. Each modular multiply becomes two
+# plain multiplies, a mask and a shift - no division by n - which is how
+# real-world crypto libraries do it. Being interpreted it's usually slower
+# than the built-in pow(), so it's only used if USE_MONTPOW is set. n must
+# be odd, as RSA moduli and prime candidates always are. R = 2**k is the
+# 'Montgomery radix'.
+def montSetup(n):
+    k = bitLen(n)
+    mask = (1 << k) - 1
+    # Newton's iteration for 1/n mod R, each pass doubles the correct bits
+    inv, bits = n, 3 # n*n == 1 mod 8 for any odd n
+    while bits < k:
+        inv = (inv * (2 - n * inv)) & mask
+        bits *= 2
+    return k, mask, mask + 1 - inv # -1/n mod R
+
+# Montgomery reduction, returns T/R mod n for any T < n*R
+def redc(T, n, k, mask, nInv):
+    m = ((T & mask) * nInv) & mask
+    t = (T + m * n) >> k
+    return t - n if t >= n else t
+
+# Equivalent to pow(b, x, n) for odd n. Rather than multiplying by b for
+# every set bit of x we scan x in 'windows' of up to win bits, each
+# starting and ending with a set bit, and multiply by a precomputed odd
+# power of b - roughly halving the number of multiplies for big x.
+def montPow(b, x, n, win=5):
+    k, mask, nInv = montSetup(n)
+    bM = (b << k) % n # into Montgomery form, the only division
+    b2 = redc(bM * bM, n, k, mask, nInv)
+    odd = [bM] # b, b**3, b**5 ... b**(2**win - 1)
+    for i in range(1, 1 << (win-1)):
+        odd.append(redc(odd[-1] * b2, n, k, mask, nInv))
+    xM = (1 << k) % n # ie 1 in Montgomery form
+    i = bitLen(x) - 1
+    while i >= 0:
+        if (x >> i) & 1 == 0:
+            xM = redc(xM * xM, n, k, mask, nInv)
+            i -= 1
+            continue
+        j = max(i - win + 1, 0) # window is bits i down to j
+        while (x >> j) & 1 == 0: j += 1
+        for _ in range(i - j + 1):
+            xM = redc(xM * xM, n, k, mask, nInv)
+        w = (x >> j) & ((1 << (i - j + 1)) - 1)
+        xM = redc(xM * odd[w >> 1], n, k, mask, nInv)
+        i = j - 1
+    return redc(xM, n, k, mask, nInv) # out of Montgomery form
+
+if USE_MONTPOW: powmod = montPow
+
+# Private key operation, equivalent to pow(m, d, n) but around 4x faster.
+# By the Chinese Remainder Theorem we can work mod p and mod q separately,
+# with half-size numbers, and then recombine the two results.
+# dp, dq & qinv are precomputed by keyGen()
+def privCrypt(m, p, q, dp, dq, qinv):
+    m1 = powmod(m, dp, p)
+    m2 = powmod(m, dq, q)
+    h = (qinv * (m1 - m2)) % p
+    return int(m2 + h * q)
+
+# A public key (n,e) along with its compact base64 text form for distribution,
+# built once so the integers can be used directly from then on
+PublicKey = namedtuple('PublicKey', 'n e b64')
+
+def makePubKey(n, e):
+    return PublicKey(n, e, f"{bigInt2B64(n)},{bigInt2B64(e)}")
+
+# Re-create a public key from its base64 text form
+def B642PubKey(strIn):
+    try:
+        pkTmp = strIn.split(',')
+        assert len(pkTmp) == 2
+        n,e = B642bigInt(pkTmp[0]), B642bigInt(pkTmp[1])
+    except:
+        raise ValueError('Bad public key!')
+    return PublicKey(n, e, strIn)
+
 # Split a long string into chunks for printing
 def chunkify(txt, width):
-    chunks = []
-    for i in range(0, len(txt), width):
-        chunks.append(txt[i:i+width])
-    return '\n'.join(chunks)
+    return '\n'.join(txt[i:i+width] for i in range(0, len(txt), width))
+
+# Uniform random integer in the range 0..n-1
+# Draw just enough random bits and try again if we overshoot (< 1 in 2)
+def randBelow(n):
+    nBits = bitLen(n)
+    mask = (1 << nBits) - 1
+    while True:
+        rnd = int.from_bytes(randBytes((nBits+7)//8), 'big') & mask
+        if rnd < n: return rnd
+
+# miller-rabin test, a is the 'witness', n-1 == d * 2**s with d odd
+def millerTest(d, s, n, a):    
+    nm1 = n - 1
+    x = powmod(mpz(a), d, n)
+    if (x == 1) or (x == nm1): return True
+    for i in range(s - 1):
+        x = (x * x) % n
+        if (x == 1): return False
+        if (x == nm1): return True
+    return False
+
+# Use a miller-rabin test [scrounged from the internet] to _statistically_ test a number for
+# probable primality - to a programmable degree of certainty (govered by k below)
+def IsPrime(n):
+    if n <= 3: return n > 1
+    if (n&1 == 0): return False
+    for sp in SMALL_PRIMES:
+        if n % sp == 0: return n == sp
+    if n < 1000*1000: return True # no factors up to sqrt(n)
+    n = mpz(n) # so the squarings below run in GMP if available
+    d = n - 1
+    s = bitLen(d & -d) - 1 # count the trailing zero bits...
+    d >>= s                # and strip them in one go
+    # Up to certain limits, fixed sets of witnesses are known to give
+    # a definite answer. Beyond that we pick k random witnesses, FIPS
+    # 186-4 recommends 7, 5 & 4 rounds for 512, 1024 & 1536 bit primes,
+    # smaller numbers need more rounds for the same degree of certainty.
+    if n < (1 << 64):
+        witnesses = (2, 325, 9375, 28178, 450775, 9780504, 1795265022)
+    elif n < 318665857834031151167461:
+        witnesses = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37)
+    else:
+        nBits = bitLen(n)
+        if   nBits >= 1536: k = 4
+        elif nBits >= 1024: k = 5
+        elif nBits >= 512:  k = 7
+        else: k = max(7, 64 - nBits//8) # no of itterations
+        witnesses = [2 + randBelow(n - 3) for i in range(k)]
+    for a in witnesses:
+        a %= n
+        if a == 0: continue # witness is a multiple of n, skip it
+        if millerTest(d, s, n, a) == False: return False
+    return True
+
+# Hunt for primes - SLOW!
+def getBigPrime(nBits):
+    # Start from a random odd number of exactly nBits bits, with the top
+    # two bits set so that the product of two such primes is never a
+    # bit short of the sum of their lengths
+    nBytes = (nBits+7)//8
+    n = int.from_bytes(randBytes(nBytes), 'big') >> (8*nBytes - nBits)
+    n |= (3 << (nBits-2)) | 1
+    # IsPrime weeds out the ~7 in 8 candidates with small factors by
+    # trial division before it gets to the (slow) Miller-Rabin test
+    while not IsPrime(n): n += 2
+    return n
 
 # Generate a private/public key pair,
 # Std key-sizes are 1024bits (weak), 2048 (ok), 3072 (strong)
 def keyGen(keySize=1024): # keySize in bits
-    from os import urandom as randBytes
-    #
-    def randBelow(n):
-        rnd = int.from_bytes(randBytes(bytLen(n)), 'big')
-        while rnd > n: rnd >>= 1 
-        return rnd
-    #
-    # Use a miller-rabin test [scrounged from the internet] to _statistically_ test a number for
-    # probable primality - to a programmable degree of certainty (govered by k below)
-    def IsPrime(n):
-        # miller-rabin test...
-        def millerTest(d, n):    
-            a = 2 + randBelow(n - 4)
-            x = pow(a, d, n)
-            if (x == 1) or (x == n-1): return True
-            while (d != n-1):
-                x = (x * x) % n
-                d *= 2
-                if (x == 1): return False
-                if (x == n-1): return True
-            return False
-        #
-        k = min(int(len(str(n))/5)+4, 64) # no of itterations
-        if n <= 3: return n > 1
-        if (n&1 == 0): return False
-        d = n - 1
-        while (d % 2 == 0): d //= 2
-        for i in range(k):
-            if millerTest(d, n) == False: return False
-        return True
-    #
-    # Hunt for primes - SLOW!
-    def getBigPrime(nBits):
-        n = int.from_bytes(randBytes(nBits//8), 'big') | 1
-        while not IsPrime(n): n += 2
-        return n
-    #
     # A minimal implemetation of the "extended euclidean algorithm" to find
     # the "multiplicative inverse" of e mod u
     # Equivalent to pow(e, -1, u) - not supported in older Pythons or uPy.
+    # Only the coefficient of e is needed, so we don't track the one for u.
     def eea(e, u):
         a,b = e,u
-        cd  = [(1,0),(0,1),(0,0)]
+        c1,c2 = 1,0
         while b > 0:
-            q,r = a//b, a%b
-            cd[2] = (cd[0][0]-q*cd[1][0], cd[0][1]-q*cd[1][1])
-            for i in (0,1): cd[i] = cd[i+1]
+            q,r = divmod(a, b)
+            c1,c2 = c2, c1-q*c2
             a,b = b,r
         if a != 1: return None # Impossible
-        return cd[0][0]%u;
+        return c1%u
     #
     # OK, Find two big primes (should not be 'close' to one-another)...
     # Note: "with current factorization technology, the advantage
     # of using 'safe' or 'strong' primes appears to be negligible" [wikipedia]
     #
-    p = getBigPrime((KEY_SIZE//2)+1)
-    q = getBigPrime((KEY_SIZE//2)-1)
+    # The two searches are independent so, where possible, we run them
+    # side by side in separate processes. Starting the processes takes
+    # about as long as the whole search for smaller keys, so it's only
+    # worth it for big keys on a multi-core machine.
+    #
+    p = q = None
+    if ProcessPoolExecutor and keySize >= 2048 and (cpu_count() or 1) > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=2) as ex:
+                fp = ex.submit(getBigPrime, (keySize//2)+1)
+                fq = ex.submit(getBigPrime, (keySize//2)-1)
+                p, q = fp.result(), fq.result()
+        except Exception: # eg no multiprocessing support, do it the slow way
+            p = q = None
+    if p is None:
+        p = getBigPrime((keySize//2)+1)
+        q = getBigPrime((keySize//2)-1)
+    p, q = mpz(p), mpz(q) # so the arithmetic below runs in GMP if available
+    #
+    # If p & q are too close, n can be easily factored by Fermat's method.
+    # As p is two bits longer than q, p - q is always more than 2**(keySize/2 - 1)
+    # so that can't happen here. The check just guards against any future
+    # change to the prime sizes - if it fails we look for another q.
+    #
+    while bitLen(abs(p - q)) < keySize//2 - 100:
+        q = mpz(getBigPrime((keySize//2)-1))
     #
     # Create the public key, comprising two integers n & e, n is
     # the 'modulus' and e is the 'exponent'. Firstly n...
@@ -172,6 +334,8 @@ def keyGen(keySize=1024): # keySize in bits
     # The value 65537 is widely used for the exponent but we must make
     # sure it wont divide into our totient u, if by chance it does we
     # just move on until we find another prime that doesn't.
+    # For numbers this small IsPrime needs only trial division by
+    # SMALL_PRIMES, no Miller-Rabin.
     #
     e = 65537
     while (u % e == 0) or (not IsPrime(e)): e += 2
@@ -182,55 +346,61 @@ def keyGen(keySize=1024): # keySize in bits
     # d = pow(e, -1, u), or for microPython compatability we can
     # use the extended euclidean algorithm to find d
     #
-    d = eea(e, u) 
+    d = invert(e, u) if invert else eea(e, u)
+    #
+    # Finally some values that let us use the private key with half-size
+    # numbers (see privCrypt). In the real world these are kept with d.
     #
-    return (n,e,d)  # return key-set
+    dp = d % (p - 1)
+    dq = d % (q - 1)
+    qinv = invert(q, p) if invert else eea(q, p)
+    #
+    return tuple(int(k) for k in (n,e,d,p,q,dp,dq,qinv))  # return key-set
 
 
 # --------- MAIN ---------------------------
 
-# First, make a new key pair that we can use in our demo...
-# The public key is actually two integers, n & e - one very large, one
-# small: n is the product of 2 large primes and e is _usually_ 65537.
-# The private key is also a very large integer, d - it must also be used
-# in conjunction with n.
-# Here "very large" means beyond the scope of practical factorisation.
-
-print('Generating new key pair...')
-n,e,d = keyGen(2048) # create a 2048-bit public/private key pair
-
-# Make a more compact text version of the public key for distribution
-pubKey = f"{bigInt2B64(n)},{bigInt2B64(e)}"
-print(f"Public Key (n,e):\n{chunkify(pubKey, 72)}")
-print(f"Private Key (d): It's a secret, but it's {len(str(d))} decimal digits")
-
-print()
-print('Encypt / decrypt demo...')
-print()
-
-print(f"Message input:     {MSG}") # from top of the script
-
-# Encrypt (note all inputs and outputs are integers)...
-cypherN = pow(MSG, d, n) # encrypt with private key (d)
-# Yes, that's it!
-
-# Convert cypherN integer to base64 text
-cypherText = bigInt2B64(cypherN)
-print(f"\nCypher-Text:\n{chunkify(cypherText,72)}\n")
-# Pretend to transmit cypher text
-# ...
-# And receive the base64 cypher text, converting it back to integer form
-cypherRx = B642bigInt(cypherText)
-# re-create the public key integers from the base64 encoded pubKey
-try:
-    pkTmp = pubKey.split(',')
-    assert len(pkTmp) == 2
-    N,E = B642bigInt(pkTmp[0]), B642bigInt(pkTmp[1])
-except:
-    raise ValueError('Bad public key!')
+# The guard stops the demo re-running in keyGen's worker processes
+if __name__ == '__main__':
+    # First, make a new key pair that we can use in our demo...
+    # The public key is actually two integers, n & e - one very large, one
+    # small: n is the product of 2 large primes and e is _usually_ 65537.
+    # The private key is also a very large integer, d - it must also be used
+    # in conjunction with n.
+    # Here "very large" means beyond the scope of practical factorisation.
+
+    print('Generating new key pair...')
+    n,e,d,p,q,dp,dq,qinv = keyGen(KEY_SIZE) # create a KEY_SIZE-bit public/private key pair
+
+    # Make a more compact text version of the public key for distribution
+    pubKey = makePubKey(n, e)
+    print(f"Public Key (n,e):\n{chunkify(pubKey.b64, 72)}")
+    print(f"Private Key (d): It's a secret, but it's {len(str(d))} decimal digits")
+
+    print()
+    print('Encypt / decrypt demo...')
+    print()
+
+    print(f"Message input:     {MSG}") # from top of the script
+
+    # Encrypt (note all inputs and outputs are integers)...
+    # cypherN = pow(MSG, d, n) # encrypt with private key (d)
+    # Yes, that's it! Or, about 4x faster, using the private key's CRT components
+    cypherN = privCrypt(MSG, p, q, dp, dq, qinv)
+
+    # Convert cypherN integer to base64 text
+    cypherText = bigInt2B64(cypherN)
+    print(f"\nCypher-Text:\n{chunkify(cypherText,72)}\n")
+    # Pretend to transmit cypher text
+    # ...
+    # And receive the base64 cypher text, converting it back to integer form
+    cypherRx = B642bigInt(cypherText)
+    # re-create the public key integers from the base64 encoded pubKey, as
+    # the recipient would do once on receiving it
+    pkRx = B642PubKey(pubKey.b64)
 
-# Decrypt using the public key (all inputs and outputs are integers)...
-output = pow(cypherRx, E, N) # decrypt with recovered public key (N,E)
-# Again that's all there is to it!
+    # Decrypt using the public key (all inputs and outputs are integers)...
+    output = int(powmod(cypherRx, pkRx.e, pkRx.n)) # decrypt with recovered public key (n,e)
+    # Again that's all there is to it!
 
-print(f"Decrypted output:  {output}")
+    print(f"Decrypted output:  {output}")
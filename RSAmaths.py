@@ -19,143 +19,254 @@
 # https://doctrina.org/Why-RSA-Works-Three-Fundamental-Questions-Answered.html
 # upon which this is based.
 
-print('\nA trivial RSA example with step-by-step explanation...\n')
-
-# key generation...
-p = 97            # choose two secret primes, #1
-q = 233           # prime #2
-n = p*q           # public modulus: 1st part of public key
-                  # Note that for sufficiently large p & q it's not feasable
-                  # to back-calculate them knowing only n, this is the keystone upon
-                  # which RSA's security hangs. In the real world p & q would be many
-                  # hundreds of digits long and also not be close neighbours.
-u = (p-1)*(q-1)   # the 'totient', used during private key generation (keep it secret)
-e = 17            # public exponent: 2nd part of public key, this can be any relatively
-                  # small prime, but we must first check that e does not divide into u
-assert u %e != 0  # - this is just one of the rules of RSA.
-                  # 'assert' just means error out if the following expression is false
-
-# now we can calculate our private key, d - an integer such that
-#  (d*e) %u == 1
-# d is called the 'multiplicative inverse' of e under modulus u, it can easily
-# be calculated using the 'extended Euclidian algorithm' or more conveniently,
-# in modern python implementations, we can just use the pow() function thusly:
-d = pow(e, -1, u)
-assert e*d %u == 1
-# since this is such an important step let's get a better handle on it
-# with some actual numbers so you can see how it plays out:
-print(f'Check that e*d %u == 1: {e}*{d} = {e*d}, %{u} = {e*d %u} -- YES\n')
-# the totient u is crucial here, you'll see why later...
-
-# OK, we now have our public key (e & n) and our private key (d)
-print('Public key:',(n,e), '\n')
-# our private message, m, can be any +ve int < n-1
-m = 6789
-assert m < n-1
-
-# Note that even with these relatively tiny numbers some of the intermediate values get
-# un-printably large and take a noticeable time to calculate. This is because for clarity
-# we're using ** for exponentiation and % for modulus as two separate steps.
-# Modulo exponentiation is at the heart of RSA, it's pretty much all there is to it,
-# both encryption and decryption are done with a single modulo exponentiation step,
-# the genius of it is in the choice of keys - the exponents and the modulus.
-# FYI Python's pow(a,b,c) function, which implements a**b %c in one highly optimised
-# process is much much faster even when applied to very large numbers of 300+ digits.
-
-print('message to send ', m)
-
-# encrypt with public key:
-cyphertext = m**e %n
-print('cyphertext      ', cyphertext)
-
-# decrypt with private key
-mRx = cyphertext**d %n
-print('message received', mRx)
-print('\nchecking the maths step by step (may take afew seconds)...')
-# check result
-assert mRx == m
-
-# But what was going on there and how does the maths of it work?
-# Let's go take a closer look...
-
-# encryption + decription can be summarised thus:
-assert m == ( (m**e) %n )**d %n
-# which is equivalent to
-assert m == (m**e)**d %n
-# this step may not be immediately obvious but it is the case that
-# ((x %n)**y) %n == (x**y) %n, try a few simple examples, you'll see.
-# or, of course
-assert m == m**(e*d) %n    # <2>
-# remember we calculated d so that
-assert e*d %u == 1
-# or in other words, to remove the modulus:
-# e*d = Ka * u + 1,  where Ka is some integer
-# we'll quickly calculate Ka but I've a feeling we won't utimately need it...
-Ka = (e*d-1)//u  # we must use // here to keep Ka as an integer
-assert e*d == Ka * u + 1
-# expanding for u, exponentiating m and re-arranging...
-assert e*d == Ka*(p-1)*(q-1) + 1
-assert m**(e*d) == m**(Ka*(p-1)*(q-1) + 1)
-assert m**(e*d) == m * m**(Ka*(p-1)*(q-1))
-assert m**(e*d) == m * ( m**(Ka*(q-1)) )**(p-1)   # <1>
-# feels like we made it a lot more complicated, but we're actually now
-# in a good position to apply Fermat's little theorem, which states:
-# (any-int-x ** (any-prime-p - 1)) modulus p = 1, unless x is some
-# multiple of p in which case the result is zero - see footnote
-# for example:
-assert 12345**6 %7 == 1
-assert e**(q-1) %q == 1
-# with this in mind we apply mod p to both sides of <1> and get
-assert m**(e*d) %p == m * ( m**(Ka*(q-1)) )**(p-1) %p
-# now use the 'little theorem' to completely eliminate
-# "( m**(Ka*(q-1)) )**(p-1) %p" which Fermat tells us is 1
-# and so we get
-assert m**(e*d) %p == m %p  # <3>
-# abra-cadabra Ka and all that complication has gone, notice we
-# must keep the %p on the rhs as x*y%p == (x%p) * (y%p) != x * (y%p)!
-# looking again at <1>, we can re-arrange and apply the same logic
-# we just used for p equally to q, yeilding:
-assert m**(e*d) %q == m %q  # <4>
-# now it can be shown that for any integers x,y and primes p,q:
-#  if x %p == y %p and x %q == y %q then: x %(p*q) == y %(p*q)
-# sounds plausible, I've not seen a proof but have tested it numerically
-# at great length without ever finding a counter example
-# applying this rule to <3> and <4> above we can say
-assert m**(e*d) %(p*q) == m %(p*q)
-# but p*q is our public modulus n, thus
-assert m**(e*d) %n == m %n   # or since m < n...
-assert m**(e*d) %n == m
-# QED we just proved our original encrypt/decrypt equation <2>
-print('\nBing-Pot!', m**(e*d)%n, '==', m, ' QED')
-#
-# It can now be seen that, with RSA, one can encrypt with either the
-# private or public key, so long as you decrypt with the other key.
-# Private key encryption is a great way of providing authentication. 
-#
-# Footnote:
-# Interestingly the 'little theorem' zero case, resulting from the message
-# m being a multiple of p or q, is perfectly consistent with this proof
-# and does not break en/de-cryption. BUT the effects on the quality of the
-# cypher-text are another matter, consider:
-p,q,e = 97,233,17
-message = 233*5 # or 97*12
-cypher  = message**e %(p*q)
-assert cypher == message
-# The cypher-text is the same as the message, no encryption has happened!
-# Other udesirable effects are the cypher being an integer muliple or
-# fraction of the message. When scaled up to real-world key-lengths
-# the issue is mitigated by the fact that the chances of the msg being
-# a multiple of p or q aproximates to 2/sqrt(n) [where n = p*q]
-# which would be an extremely small number, but not zero. Indeed
-# finding such a message would grant easy access to the private key.
-# Also, messages are always padded with plenty of random digits,
-# which could be simply re-generated should the cypher turn out to
-# be related to the msg in some simple way. 
-# Alternatively if you keep the msg significantly shorter than
-# sqrt(n) then there's no chance at all of it being a multiple of
-# p or q. Eg for a 2048b key, maybe keep the msg+padding to under 1000
-# bits - which of course is more than enough for a 256bit AES key
-# suplemented by oodles of random padding.
+# Use GMP's modular arithmetic if gmpy2 is installed, it does exactly the
+# same jobs as Python's pow(a,b,c) and pow(a,-1,c) (see below), only faster.
+# GMP is also much quicker at turning very big numbers into decimal text.
+try:
+    from gmpy2 import mpz, powmod, invert
+except: # plain Python
+    mpz = int
+    powmod = pow
+    def invert(a, c): return pow(a, -1, c)
+
+# Real-world RSA private keys keep, along with p & q, some values worked out
+# from d that allow faster decryption - see 'Faster decryption' below
+from collections import namedtuple
+PrivKey = namedtuple('PrivKey', 'p q dp dq qinv')
+
+# numpy, if installed, speeds up one of the numerical checks
+try:
+    import numpy as np
+except: # plain Python
+    np = None
+
+# A few of the steps below check the algebra using exact (un-reduced) powers
+# of the message. These get un-printably large and take a noticeable time
+# to calculate so they're skipped unless you run: python RSAmaths.py --slow-proof
+import sys
+SLOW_PROOF = '--slow-proof' in sys.argv
+
+# Montgomery modular exponentiation, equivalent to pow(b, x, n) for odd n.
+# Working with numbers 'in Montgomery form', ie times R = 2**k mod n, each
+# reduction mod n becomes a multiply, a mask and a shift - no division.
+def montPow(b, x, n):
+    k = n.bit_length()
+    R = 1 << k
+    nInv = pow(-n, -1, R)          # so that n*nInv %R == R-1
+    def reduce(t):                 # t/R mod n, for any t < n*R
+        t = (t + ((t * nInv) & (R-1)) * n) >> k
+        return t - n if t >= n else t
+    bM = (b << k) %n               # b in Montgomery form
+    xM = R %n                      # 1 in Montgomery form
+    for bit in bin(x)[2:]:         # square-and-multiply, top bit first
+        xM = reduce(xM * xM)
+        if bit == '1': xM = reduce(xM * bM)
+    return reduce(xM)              # back out of Montgomery form
+
+# The whole walk-through lives in a function, which keeps its many
+# variables local (and a little quicker to access than module globals)
+def main():
+    print('\nA trivial RSA example with step-by-step explanation...\n')
+
+    # key generation...
+    p = 97            # choose two secret primes, #1
+    q = 233           # prime #2
+    n = p*q           # public modulus: 1st part of public key
+                      # Note that for sufficiently large p & q it's not feasable
+                      # to back-calculate them knowing only n, this is the keystone upon
+                      # which RSA's security hangs. In the real world p & q would be many
+                      # hundreds of digits long and also not be close neighbours.
+    pm1, qm1 = p-1, q-1  # we'll be needing p-1 and q-1 a few times
+    u = pm1*qm1       # the 'totient' (p-1)*(q-1), used during private key generation (keep it secret)
+    e = 17            # public exponent: 2nd part of public key, this can be any relatively
+                      # small prime, but we must first check that e does not divide into u
+    assert pm1 %e != 0 and qm1 %e != 0  # - this is just one of the rules of RSA.
+                      # 'assert' just means error out if the following expression is false
+                      # (as e is prime it divides u only if it divides p-1 or q-1, so we
+                      # can check those instead, they're half the size of u)
+
+    # now we can calculate our private key, d - an integer such that
+    #  (d*e) %u == 1
+    # d is called the 'multiplicative inverse' of e under modulus u, it can easily
+    # be calculated using the 'extended Euclidian algorithm' or more conveniently,
+    # in modern python implementations, we can just use the pow() function thusly:
+    # d = pow(e, -1, u), here we use invert(e, u) which is the same thing
+    d = int(invert(e, u))
+    assert e*d %u == 1
+    # since this is such an important step let's get a better handle on it
+    # with some actual numbers so you can see how it plays out:
+    ed = e*d  # we'll be needing e*d a lot, so let's just work it out once
+    print(f'Check that e*d %u == 1: {e}*{d} = {mpz(ed)}, %{u} = {ed %u} -- YES\n')
+    # the totient u is crucial here, you'll see why later...
+    # In practice the private key is stored in a form that speeds up decryption
+    priv = PrivKey(p, q, d %pm1, d %qm1, int(invert(q, p)))
+
+    # OK, we now have our public key (e & n) and our private key (d, or priv)
+    print('Public key:',(n,e), '\n')
+    # our private message, m, can be any +ve int < n-1
+    m = 6789
+    assert m < n-1
+
+    # Modulo exponentiation is at the heart of RSA, it's pretty much all there is to it,
+    # both encryption and decryption are done with a single modulo exponentiation step,
+    # the genius of it is in the choice of keys - the exponents and the modulus.
+    # Mathematically it's just a**b %c, but even with these relatively tiny numbers a**b
+    # gets un-printably large and takes a noticeable time to calculate. So we use Python's
+    # pow(a,b,c) function, which implements a**b %c in one highly optimised process,
+    # and is very fast even when applied to very large numbers of 300+ digits.
+    # (Or gmpy2's even faster powmod(a,b,c) if it's installed, see the top of the file)
+
+    print('message to send ', m)
+
+    # encrypt with public key:
+    cyphertext = powmod(m, e, n)
+    print('cyphertext      ', cyphertext)
+
+    # decrypt with private key
+    # Real-world RSA does this in two halves, mod p and mod q, with numbers half
+    # the size - around 4x faster, using the dp, dq & qinv we stored in priv.
+    # See 'Faster decryption' at the end for how it works.
+    m1 = powmod(cyphertext, priv.dp, priv.p)
+    m2 = powmod(cyphertext, priv.dq, priv.q)
+    h  = (priv.qinv * (m1 - m2)) %priv.p
+    mRx = m2 + h*priv.q
+    assert mRx == powmod(cyphertext, d, n) # same as decrypting in one go
+    print('message received', mRx)
+    print('\nchecking the maths step by step...')
+    if not SLOW_PROOF:
+        print('(skipping the slow exact-power checks, run with --slow-proof to include them)')
+    # check result
+    assert mRx == m
+
+    # But what was going on there and how does the maths of it work?
+    # Let's go take a closer look...
+    # (m**(e*d) mod n, p & q and m mod n, p & q crop up several times below,
+    # so we'll work them out just once here)
+    medN, medP, medQ = powmod(m, ed, n), powmod(m, ed, p), powmod(m, ed, q)
+    mN, mP, mQ = m %n, m %p, m %q
+
+    # encryption + decription can be summarised thus:
+    assert m == powmod(powmod(m, e, n), d, n)
+    # which is equivalent to
+    assert m == powmod(m**e, d, n)
+    # this step may not be immediately obvious but it is the case that
+    # ((x %n)**y) %n == (x**y) %n, try a few simple examples, you'll see.
+    # or, of course
+    assert m == medN    # <2>  ie m == m**(e*d) %n
+    # remember we calculated d so that
+    assert ed %u == 1
+    # or in other words, to remove the modulus:
+    # e*d = Ka * u + 1,  where Ka is some integer
+    # we'll quickly calculate Ka but I've a feeling we won't utimately need it...
+    Ka, r = divmod(ed, u)  # integer division, giving both Ka and the remainder
+    assert r == 1
+    assert ed == Ka * u + 1
+    # expanding for u, exponentiating m and re-arranging...
+    assert ed == Ka*(p-1)*(q-1) + 1
+    if SLOW_PROOF: # these exact powers of m have millions of digits
+        assert m**ed == m**(Ka*(p-1)*(q-1) + 1)
+        assert m**ed == m * m**(Ka*(p-1)*(q-1))
+        assert m**ed == m * ( m**(Ka*(q-1)) )**(p-1)   # <1>
+    # feels like we made it a lot more complicated, but we're actually now
+    # in a good position to apply Fermat's little theorem, which states:
+    # (any-int-x ** (any-prime-p - 1)) modulus p = 1, unless x is some
+    # multiple of p in which case the result is zero - see footnote
+    # for example:
+    # (pow(b,e,m) reduces mod m after every squaring; b**e %m does not)
+    assert powmod(12345, 6, 7) == 1
+    assert powmod(e, qm1, q) == 1
+    # with this in mind we apply mod p to both sides of <1> and get
+    if SLOW_PROOF: # the slow, exact form
+        assert m**ed %p == m * ( m**(Ka*(q-1)) )**(p-1) %p
+    # which we can check in no time by reducing mod p as we go
+    assert medP == m * powmod(powmod(m, Ka*qm1, p), pm1, p) %p
+    # now use the 'little theorem' to completely eliminate
+    # "( m**(Ka*(q-1)) )**(p-1) %p" which Fermat tells us is 1
+    # and so we get
+    assert medP == mP  # <3>  ie m**(e*d) %p == m %p
+    # abra-cadabra Ka and all that complication has gone, notice we
+    # must keep the %p on the rhs as x*y%p == (x%p) * (y%p) != x * (y%p)!
+    # looking again at <1>, we can re-arrange and apply the same logic
+    # we just used for p equally to q, yeilding:
+    assert medQ == mQ  # <4>  ie m**(e*d) %q == m %q
+    # now it can be shown that for any integers x,y and primes p,q:
+    #  if x %p == y %p and x %q == y %q then: x %(p*q) == y %(p*q)
+    # sounds plausible, I've not seen a proof but have tested it numerically
+    # at great length without ever finding a counter example
+    # Here's a quick test for our p & q: the pairs (x %p, x %q) for every
+    # x from 0 to p*q-1 (ie n-1) are all different, so each pair pins down x %n
+    if np is not None: # all at once, in numpy's compiled loops
+        x = np.arange(n, dtype=np.int64)
+        assert np.unique(x %p * q + x %q).size == n
+    else:
+        assert len({(x %p, x %q) for x in range(n)}) == n
+    # applying this rule to <3> and <4> above we can say
+    #  m**(e*d) %(p*q) == m %(p*q)
+    # but p*q is our public modulus n, thus
+    assert medN == mN == m   # the last since m < n, so m %n is just m
+    # QED we just proved our original encrypt/decrypt equation <2>
+    # Put another way, as n is the product of two different primes, when
+    # working mod n we can knock multiples of u off any exponent so long as
+    # it stays at least 1 - ie m**(k*u + x) %n == m**x %n for x >= 1, even
+    # if m shares a factor with n (but not for x = 0, eg p**u %n != 1).
+    # Since e*d %u is 1, m**(e*d) %n is simply m**1 %n - no squaring needed
+    edReduced = ed %u  # == 1 by construction
+    assert powmod(m, edReduced, n) == medN
+    print('\nBing-Pot!', medN, '==', m, ' QED')
+    #
+    # It can now be seen that, with RSA, one can encrypt with either the
+    # private or public key, so long as you decrypt with the other key.
+    # Private key encryption is a great way of providing authentication. 
+    #
+    # Faster decryption:
+    # The rule we used above, that a number below n is pinned down by its
+    # values mod p and mod q, is known as the Chinese Remainder Theorem and it
+    # lets us split decryption in two. Fermat's little theorem tells us that
+    # cyphertext**d %p == cyphertext**(d %(p-1)) %p, so the message mod p is
+    assert m1 == mP  # ie m %p
+    # and likewise the message mod q is
+    assert m2 == mQ  # ie m %q
+    # both calculated with half-size numbers. To glue them back together we
+    # want the number m2 + h*q (which is still m2 mod q) that is also m1 mod p,
+    # qinv is the multiplicative inverse of q mod p, so h = qinv*(m1-m2) %p does it
+    assert priv.qinv*q %p == 1
+    assert (m2 + h*q) %p == m1 and (m2 + h*q) %q == m2
+    #
+    # Montgomery multiplication:
+    # Every %n in a modular exponentiation is a (slow) division. Real-world
+    # RSA libraries avoid it with Montgomery's trick, which swaps it for a
+    # multiply, a mask and a shift, see montPow() near the top of the file.
+    # It gives exactly the same answers:
+    assert montPow(m, e, n) == cyphertext
+    assert montPow(cyphertext, d, n) == m
+    #
+    # Footnote:
+    # Interestingly the 'little theorem' zero case, resulting from the message
+    # m being a multiple of p or q, is perfectly consistent with this proof
+    # and does not break en/de-cryption. BUT the effects on the quality of the
+    # cypher-text are another matter, consider:
+    p,q,e = 97,233,17
+    message = 233*5 # or 97*12
+    cypher  = powmod(message, e, p*q)
+    assert cypher == message
+    # The cypher-text is the same as the message, no encryption has happened!
+    # Other udesirable effects are the cypher being an integer muliple or
+    # fraction of the message. When scaled up to real-world key-lengths
+    # the issue is mitigated by the fact that the chances of the msg being
+    # a multiple of p or q aproximates to 2/sqrt(n) [where n = p*q]
+    # which would be an extremely small number, but not zero. Indeed
+    # finding such a message would grant easy access to the private key.
+    # Also, messages are always padded with plenty of random digits,
+    # which could be simply re-generated should the cypher turn out to
+    # be related to the msg in some simple way. 
+    # Alternatively if you keep the msg significantly shorter than
+    # sqrt(n) then there's no chance at all of it being a multiple of
+    # p or q. Eg for a 2048b key, maybe keep the msg+padding to under 1000
+    # bits - which of course is more than enough for a 256bit AES key
+    # suplemented by oodles of random padding.
+
+if __name__ == '__main__':
+    main()
 # ---
 # SJM Dec 24
 # With profound respect to the geniuses who figured this out back in the 70's